@@ -1,5 +1,8 @@
 from importlib import import_module
 import octoprint
+import metrics
+import history
+import health
 import os
 import flask
 import threading
@@ -32,7 +35,9 @@ CONFIG = './config.yml'
 PRINTERS = './printers.yml'
 KEYS = "./keys.yml"
 LISTS = "./lists.yml"
-HISTORY = "./history.yml"
+HISTORY = history.DATABASE
+METRICS = metrics.SNAPSHOT
+HEALTH = health.SNAPSHOT
     
 def background_thread():
     """How to send server generated events to clients."""
@@ -41,27 +46,41 @@ def background_thread():
         
         with open(PRINTERS, "r") as yamlfile:
             printers = yaml.load(yamlfile, Loader=yaml.FullLoader)
-        for printer in printers['PRINTERS']:
-            apikey = printers['PRINTERS'][printer]['api']
-            printerIP = printers['PRINTERS'][printer]['ip']
-            status = octoprint.GetStatus(printerIP,apikey)
-            if status['progress']['completion'] is None:
+        farmHealth = health.loadSnapshot(HEALTH)
+        for printer in printers['farm_printers']:
+            apikey = printers['farm_printers'][printer]['api']
+            printerIP = printers['farm_printers'][printer]['ip']
+            # printers the farm loop has marked down aren't polled, so a dead pi doesn't stall the dashboard
+            if (farmHealth.get(apikey) or {}).get('state') == "down":
+                status = "offline"
+            else:
+                status = octoprint.GetStatus(printerIP,apikey)
+            if status == "offline":
+                percent = 0
+                eta = 0
+                state = "Offline"
+            elif status['progress']['completion'] is None:
                 percent = 0
                 eta = 0
+                state = str(status['state'])
             else:
                 percent = str(round(status['progress']['completion'], 2))
-                eta = str(round(status['progress']['printTimeLeft'], 0))
+                eta = str(round(status['progress']['printTimeLeft'] or 0, 0))
+                state = str(status['state'])
             
             socketio.emit('my_response', {
                 'api' : apikey,
                 'percent': percent,
-                'status': str(status['state']),
+                'status': state,
+                'health': health.describe(apikey, farmHealth),
                 'eta': eta
             })
         
 @app.route('/')
 def index():
-    return flask.render_template('main.html', async_mode=socketio.async_mode, config=config, ip=flask.request.host)
+    with open(PRINTERS, "r") as yamlfile:
+        printers = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    return flask.render_template('main.html', async_mode=socketio.async_mode, config=config, printers=printers, ip=flask.request.host)
 
 @socketio.event
 def connect():
@@ -120,6 +139,23 @@ def download(filename):
 def dir_listing():
     files = os.listdir(DOWNLOAD_FOLDER)
     return flask.render_template('queue.html', files=files, ip=flask.request.host)
+
+### print history rollups for reports, /history/printer, /history/day or /history/material with optional ?start=&end= days ###
+@app.route('/history/<by>')
+def history_rollup(by):
+    if by not in history.ROLLUPS:
+        flask.abort(404)
+    rows = history.rollup(by, request.args.get('start'), request.args.get('end'), HISTORY)
+    return flask.jsonify(rows)
+
+### prometheus scrape target, the farm loop writes this file at the end of every tick ###
+@app.route('/metrics')
+def metrics_endpoint():
+    body = ""
+    if os.path.exists(METRICS):
+        with open(METRICS) as f:
+            body = f.read()
+    return flask.Response(body, mimetype='text/plain; version=0.0.4')
     
 
 if __name__ == '__main__':
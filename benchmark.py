@@ -0,0 +1,106 @@
+import sys
+import time
+import logging
+import argparse
+import statistics
+import tracemalloc
+import simulator
+
+### End to end benchmark: runs main.py's jobs against 5, 50 and 500 simulated printers ###
+### $ python3 benchmark.py --printers 50 --tickets 5000 --ticks 20 --latency 0.02 --failure-rate 0.01 ###
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+### run one scenario and return a dict of results ###
+def runScenario(printers, tickets, ticks, tickSeconds, printSeconds, latency, failureRate, statusRate, dead, deadDelay, seed):
+    tracemalloc.start()
+    with simulator.Farm(printers=printers, tickets=tickets, latency=latency, failureRate=failureRate,
+                        printSeconds=printSeconds, dead=dead, deadDelay=deadDelay, seed=seed) as farm:
+        started = time.time()
+        tickDurations = []
+        jiraPerTick = []
+        octoprintPerTick = []
+        failures = 0
+        for tick in range(ticks):
+            tickStart = time.perf_counter()
+            jiraBefore = farm.jiraServer.requests
+            octoprintBefore = farm.octoprintServer.requests
+            farm.jiraServer.requestStatus(statusRate)
+            durations, failed = farm.tick()
+            failures += len(failed)
+            jiraPerTick.append(farm.jiraServer.requests - jiraBefore)
+            octoprintPerTick.append(farm.octoprintServer.requests - octoprintBefore)
+            elapsed = time.perf_counter() - tickStart
+            tickDurations.append(elapsed)
+            if elapsed < tickSeconds:
+                time.sleep(tickSeconds - elapsed)
+        finished = time.time()
+
+        dispatched = farm.octoprintServer.dispatched
+        created = farm.jiraServer.issues
+        latencies = [dispatched[key] - created[key]["created"] for key in dispatched if key in created]
+        farmSeconds = (finished - started) * printers
+        idle = 1.0 - farm.octoprintServer.busySeconds(finished) / farmSeconds if farmSeconds else float("nan")
+        statuses = farm.jiraServer.countByStatus()
+        queue = farm.queueDepth()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "printers": printers,
+        "tickets": tickets,
+        "ticks": ticks,
+        "tick_mean": statistics.mean(tickDurations),
+        "tick_max": max(tickDurations),
+        "jira_per_tick": statistics.mean(jiraPerTick),
+        "octoprint_per_tick": statistics.mean(octoprintPerTick),
+        "dispatched": len(latencies),
+        "dispatch_p50": percentile(latencies, 0.50),
+        "dispatch_p95": percentile(latencies, 0.95),
+        "idle": idle,
+        "queue": queue,
+        "failures": failures,
+        "statuses": statuses,
+        "peak_mb": peak / (1024 * 1024),
+    }
+
+def report(result):
+    print("printers=%(printers)d tickets=%(tickets)d ticks=%(ticks)d" % result)
+    print("  tick seconds          mean %(tick_mean).3f  max %(tick_max).3f" % result)
+    print("  jira requests/tick    %(jira_per_tick).1f" % result)
+    print("  octoprint req/tick    %(octoprint_per_tick).1f" % result)
+    print("  dispatched            %(dispatched)d  (p50 %(dispatch_p50).2fs  p95 %(dispatch_p95).2fs after ticket creation)" % result)
+    print("  printer idle time     %.1f%%" % (result["idle"] * 100))
+    print("  queue depth at end    %(queue)d" % result)
+    print("  job failures          %(failures)d" % result)
+    print("  ticket statuses       " + ", ".join(k + "=" + str(v) for k, v in sorted(result["statuses"].items())))
+    print("  peak traced memory    %(peak_mb).1f MB (includes the fake servers)" % result)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the farm control loop against simulated Jira and OctoPrint servers.")
+    parser.add_argument("--printers", type=int, nargs="+", default=[5, 50, 500], help="farm sizes to run")
+    parser.add_argument("--tickets", type=int, default=2000, help="open tickets waiting in the fake jira")
+    parser.add_argument("--ticks", type=int, default=10, help="control loop ticks per scenario")
+    parser.add_argument("--tick-seconds", type=float, default=1.0, help="minimum wall time per tick, like updateRate")
+    parser.add_argument("--print-seconds", type=float, default=3.0, help="mean simulated print duration")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake server response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument("--status-rate", type=float, default=0.05, help="share of printing tickets asking for status each tick")
+    parser.add_argument("--dead", type=int, default=0, help="printers whose pi never answers")
+    parser.add_argument("--dead-delay", type=float, default=0.0, help="seconds a dead pi hangs before the connection drops")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # the farm modules log every request, keep the benchmark output readable
+    logging.basicConfig(level=logging.WARNING)
+    for printers in args.printers:
+        result = runScenario(printers, args.tickets, args.ticks, args.tick_seconds, args.print_seconds,
+                             args.latency, args.failure_rate, args.status_rate, args.dead, args.dead_delay, args.seed)
+        report(result)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
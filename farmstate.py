@@ -0,0 +1,58 @@
+import os
+
+### Ticket -> job -> printer index for the farm loop ###
+### The queue is synced from the jiradownloads listing eachNewFile already does, dispatch and harvest update the ###
+### printing entries, and every /api/job poll the loop already makes is cached so status replies need no farm sweep ###
+
+tickets = {}
+printers = {}
+
+### file names are "<ticket>" or "<attachment name>__<ticket>", the same split jira.commentStatus uses ###
+def ticketOf(file):
+    return os.path.splitext(file)[0].rsplit('__', 1)[-1]
+
+### replace the queued entries with what is in jiradownloads right now ###
+def syncQueue(files):
+    queued = {}
+    for file in files:
+        queued[ticketOf(file)] = os.path.splitext(file)[0]
+    for ticket in list(tickets):
+        if tickets[ticket]["state"] == "queued" and ticket not in queued:
+            del tickets[ticket]
+    for ticket in queued:
+        if ticket not in tickets:
+            tickets[ticket] = {"state": "queued", "file": queued[ticket], "printer": None}
+
+### a file was uploaded to a printer ###
+def dispatched(file, printer):
+    tickets[ticketOf(file)] = {"state": "printing", "file": file, "printer": printer}
+
+### a printer was harvested so its ticket is done ###
+def harvested(file):
+    tickets.pop(ticketOf(file), None)
+
+### cache the latest /api/job answer for a printer, also picks up prints started before the loop was restarted ###
+def printerStatus(printer, status):
+    printers[printer] = status
+    if status == "offline" or status.get('state') != "Printing":
+        return
+    name = ((status.get('job') or {}).get('file') or {}).get('name')
+    if name:
+        tickets[ticketOf(name)] = {"state": "printing", "file": os.path.splitext(name)[0], "printer": printer}
+
+### what we know about a ticket: (state, printer, cached printer status), state is None when the ticket isn't in the farm ###
+def lookup(ticket):
+    entry = tickets.get(ticket)
+    if entry is None:
+        return None, None, None
+    if entry["state"] == "queued":
+        return "queued", None, None
+    status = printers.get(entry["printer"])
+    if status is None or status == "offline":
+        return "printing", entry["printer"], None
+    name = ((status.get('job') or {}).get('file') or {}).get('name')
+    if name is None or ticketOf(name) != ticket:
+        # the printer moved on without a harvest, e.g. the print was cancelled at the printer
+        del tickets[ticket]
+        return None, None, None
+    return "printing", entry["printer"], status
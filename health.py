@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import logging
+import yaml
+
+### Per printer health: consecutive failure counts and a circuit breaker so dead pis stop costing every tick a timeout ###
+# A printer starts "up". After failureThreshold failures in a row its breaker opens and it is "down",
+# nothing polls it until retryAt. The first call after that is a single probe ("probing"). A good answer
+# closes the breaker, another failure opens it again with the backoff doubled, up to backoffMax seconds.
+
+with open("config.yml", "r") as yamlfile:
+    config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+
+settings = config.get('printerHealth') or {}
+FAILURE_THRESHOLD = settings.get('failureThreshold', 3)
+BACKOFF_START = settings.get('backoffStart', 30)
+BACKOFF_MAX = settings.get('backoffMax', 900)
+
+### the farm loop writes its health state here every tick so the dashboard shows the same breaker the dispatcher uses ###
+SNAPSHOT = "./health.json"
+
+log = logging.getLogger("health")
+
+### printers are keyed by api key since every printer has its own and the ip is shared in some setups ###
+printers = {}
+
+def _printer(apikey, name=None):
+    if apikey not in printers:
+        printers[apikey] = {
+            "name": name or apikey,
+            "state": "up",
+            "failures": 0,
+            "backoff": 0,
+            "retryAt": 0.0,
+            "lastError": None,
+        }
+    elif name is not None:
+        printers[apikey]["name"] = name
+    return printers[apikey]
+
+### should we talk to this printer right now, a down printer is let through once its backoff is over as a probe ###
+def allow(apikey, name=None):
+    printer = _printer(apikey, name)
+    if printer["state"] == "down":
+        if time.time() < printer["retryAt"]:
+            return False
+        printer["state"] = "probing"
+        log.info("probing printer=%s after backoff=%ss", printer["name"], printer["backoff"])
+    return True
+
+### the printer answered properly ###
+def success(apikey):
+    printer = _printer(apikey)
+    if printer["state"] != "up":
+        log.info("printer recovered printer=%s after failures=%s", printer["name"], printer["failures"])
+    printer["state"] = "up"
+    printer["failures"] = 0
+    printer["backoff"] = 0
+    printer["lastError"] = None
+
+### the printer timed out, refused the connection or answered with an error ###
+def failure(apikey, reason=""):
+    printer = _printer(apikey)
+    printer["failures"] += 1
+    printer["lastError"] = reason
+    if printer["state"] == "probing":
+        printer["backoff"] = min(printer["backoff"] * 2, BACKOFF_MAX)
+    elif printer["state"] == "up" and printer["failures"] >= FAILURE_THRESHOLD:
+        printer["backoff"] = BACKOFF_START
+    else:
+        return
+    printer["state"] = "down"
+    printer["retryAt"] = time.time() + printer["backoff"]
+    log.warning("printer down printer=%s failures=%s retry_in=%ss reason=%s", printer["name"], printer["failures"], printer["backoff"], reason)
+
+def isUp(apikey):
+    return _printer(apikey)["state"] != "down"
+
+### write the health state out for the flask app, replace so a read never sees half a file ###
+def dump(path=SNAPSHOT):
+    temp = path + ".tmp"
+    with open(temp, "w") as f:
+        json.dump(printers, f)
+    os.replace(temp, path)
+
+### the farm loop's health state, empty if the loop hasn't written one yet ###
+def loadSnapshot(path=SNAPSHOT):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+### short human readable state for the dashboard, from a snapshot or this process's own state ###
+def describe(apikey, snapshot=None):
+    printer = (printers if snapshot is None else snapshot).get(apikey)
+    if printer is None:
+        return "unknown"
+    if printer["state"] == "down":
+        return "down, retry in " + str(max(0, int(printer["retryAt"] - time.time()))) + "s"
+    if printer["failures"] > 0:
+        return printer["state"] + " (" + str(printer["failures"]) + " failed)"
+    return printer["state"]
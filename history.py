@@ -0,0 +1,112 @@
+import time
+import sqlite3
+
+### Print history: an append only sqlite event log plus rollups kept up to date on every write ###
+### Reports read the rollup table, one row per day, printer and material, so they never rescan the raw events ###
+
+DATABASE = "./history.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS prints (
+    id INTEGER PRIMARY KEY,
+    finished_at REAL NOT NULL,
+    day TEXT NOT NULL,
+    printer TEXT NOT NULL,
+    material TEXT NOT NULL,
+    ticket TEXT NOT NULL,
+    uploaded_at REAL NOT NULL,
+    grams REAL NOT NULL,
+    cost REAL NOT NULL,
+    print_seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prints_ticket ON prints (ticket);
+CREATE UNIQUE INDEX IF NOT EXISTS prints_once ON prints (ticket, printer, uploaded_at);
+CREATE TABLE IF NOT EXISTS rollup (
+    day TEXT NOT NULL,
+    printer TEXT NOT NULL,
+    material TEXT NOT NULL,
+    prints INTEGER NOT NULL,
+    grams REAL NOT NULL,
+    cost REAL NOT NULL,
+    print_seconds REAL NOT NULL,
+    PRIMARY KEY (day, printer, material)
+) WITHOUT ROWID;
+"""
+
+ROLLUPS = {
+    "printer": "printer",
+    "day": "day",
+    "material": "material",
+}
+
+### open the database, creating the tables the first time ###
+def connect(path=None):
+    connection = sqlite3.connect(path or DATABASE, timeout=10)
+    # the farm loop writes while the flask app reads, WAL lets both happen at once
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+### append one finished print and fold it into the rollup in the same transaction ###
+### uploadedAt is octoprint's upload time for the job file, the same print recorded twice is ignored the second time ###
+def record(printer, material, ticket, grams, cost, printSeconds=0.0, uploadedAt=0, finishedAt=None, path=None):
+    finishedAt = finishedAt or time.time()
+    day = time.strftime("%Y-%m-%d", time.localtime(finishedAt))
+    connection = connect(path)
+    try:
+        with connection:
+            inserted = connection.execute(
+                "INSERT OR IGNORE INTO prints (finished_at, day, printer, material, ticket, uploaded_at, grams, cost, print_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (finishedAt, day, printer, material, ticket, uploadedAt, grams, cost, printSeconds)
+            ).rowcount
+            if inserted == 0:
+                return False
+            connection.execute(
+                "INSERT INTO rollup (day, printer, material, prints, grams, cost, print_seconds) VALUES (?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT (day, printer, material) DO UPDATE SET "
+                "prints = prints + 1, grams = grams + excluded.grams, cost = cost + excluded.cost, print_seconds = print_seconds + excluded.print_seconds",
+                (day, printer, material, grams, cost, printSeconds)
+            )
+        return True
+    finally:
+        connection.close()
+
+### totals grouped by printer, day or material, optionally limited to days between start and end (YYYY-MM-DD) ###
+def rollup(by, start=None, end=None, path=None):
+    column = ROLLUPS[by]
+    query = "SELECT " + column + ", SUM(prints), SUM(grams), SUM(cost), SUM(print_seconds) FROM rollup"
+    where = []
+    params = []
+    if start is not None:
+        where.append("day >= ?")
+        params.append(start)
+    if end is not None:
+        where.append("day <= ?")
+        params.append(end)
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " GROUP BY " + column + " ORDER BY " + column
+    connection = connect(path)
+    try:
+        rows = connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
+    return [
+        {by: row[0], "prints": row[1], "grams": round(row[2], 2), "cost": round(row[3], 2), "print_seconds": round(row[4], 0)}
+        for row in rows
+    ]
+
+### the raw events for one ticket, for looking up what happened to a single print ###
+def ticketHistory(ticket, path=None):
+    connection = connect(path)
+    try:
+        rows = connection.execute(
+            "SELECT finished_at, printer, material, grams, cost, print_seconds FROM prints WHERE ticket = ? ORDER BY finished_at",
+            (ticket,)
+        ).fetchall()
+    finally:
+        connection.close()
+    return [
+        {"finished_at": row[0], "printer": row[1], "material": row[2], "grams": row[3], "cost": row[4], "print_seconds": row[5]}
+        for row in rows
+    ]
@@ -6,6 +6,9 @@ import yaml
 from google_drive_downloader import GoogleDriveDownloader as gdd
 import os
 import time
+import logging
+import metrics
+import farmstate
 
 ### load all of our config files ###
 with open("config.yml", "r") as yamlfile:
@@ -20,16 +23,19 @@ with open("printers.yml", "r") as yamlfile:
 ### jira authentical information that gets pulled in from the config ###
 auth = HTTPBasicAuth(config['jira_user'], config['jira_password'])
 
+log = logging.getLogger("jira")
+
 ### Get the list of issues in the jira project ###
 def issueList():
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print("Checking for new submissions...")
+    log.info("checking for new submissions")
     url = config['base_url'] + "/rest/api/2/" + config['search_url']
     headers = {
        "Accept": "application/json"
     }
     
-    response = requests.request(
+    response = metrics.request(
+       "jira",
+       "search",
        "GET",
        url,
        headers=headers,
@@ -44,6 +50,7 @@ def issueList():
     return issues
 
 ### Gets the files and puts them where they need to be ###
+@metrics.timeJob
 def getGcode():
     for issue in issueList():
         id = issue.split("/")
@@ -53,7 +60,9 @@ def getGcode():
            "Accept": "application/json"
         }
         
-        response = requests.request(
+        response = metrics.request(
+           "jira",
+           "issue",
            "GET",
            url,
            headers=headers,
@@ -93,14 +102,21 @@ def getGcode():
 ### if the jira project has a google drive link in the description download it ###
 def downloadGoogleDrive(file_ID, singleID):
     if config['Make_files_anon'] == True:
-        gdd.download_file_from_google_drive(file_id=file_ID, dest_path="jiradownloads/" + singleID + ".gcode")
-        file = open("jiradownloads/" + singleID + ".gcode", "r")
+        dest_path = "jiradownloads/" + singleID + ".gcode"
     else:
-        gdd.download_file_from_google_drive(file_id=file_ID, dest_path="jiradownloads/" + file_ID + "__" + singleID + ".gcode")
-        file = open("jiradownloads/" + file_ID + "__" + singleID + ".gcode", "r")
+        dest_path = "jiradownloads/" + file_ID + "__" + singleID + ".gcode"
+    start = time.perf_counter()
+    status = "error"
+    try:
+        gdd.download_file_from_google_drive(file_id=file_ID, dest_path=dest_path)
+        status = "ok"
+    finally:
+        metrics.observe("farm_http_request_duration_seconds", time.perf_counter() - start, service="gdrive", endpoint="download", status=status)
+    metrics.inc("farm_bytes_downloaded_total", os.path.getsize(dest_path), service="gdrive")
+    file = open(dest_path, "r")
     
     if checkGcode(file.read()) == "Bad G-code":
-        print("Go check the gcode file");
+        log.warning("bad gcode ticket=%s source=gdrive", singleID)
         time.sleep(120);
         commentStatus(singleID, config['messages']['wrongConfig'])
         changeStatus(singleID, "11")
@@ -120,7 +136,9 @@ def download(gcode, singleID, filename):
        "Accept": "application/json"
     }
     
-    response = requests.request(
+    response = metrics.request(
+       "jira",
+       "attachment",
        "GET",
        url,
        headers=headers,
@@ -137,10 +155,11 @@ def download(gcode, singleID, filename):
         else:
             text_file = open("jiradownloads/" + filename + "__" + singleID + ".gcode", "w")
             
-        for injectGcode in config['inject_gcode']
-            injection == injection + injectGcode +" \n";
+        injection = ""
+        for injectGcode in config['inject_gcode']:
+            injection = injection + config['inject_gcode'][injectGcode] + " \n"
             
-        n = text_file.write(response.text + injection.text)
+        n = text_file.write(response.text + injection)
         text_file.close()
         changeStatus(singleID, "11")
         commentStatus(singleID, config['messages']['downloadedFile'])
@@ -151,26 +170,25 @@ def checkGcode(file):
     status = True
     for code_check in config['gcode_check_text']:
         code_to_check = config['gcode_check_text'][code_check]
-        print(code_to_check)
         if code_to_check not in file:
             status = False
         if status == False:
-            print("File is bad at: " + code_check)
+            log.warning("gcode check failed check=%s", code_check)
             return "Bad G-code"
     if status == True:
-        print("File checkedout as good")
+        log.info("gcode check passed")
         return "Valid G-code"
 ### If the print is a no go and shouldn't continue ###
 def printIsNoGo(singleIssue, singleID):
     attachments = str(singleIssue).split(',')
     if any(config['base_url'] + "/secure/attachment" in s for s in attachments):
-        print("Downloading " + singleID)
+        log.info("downloading ticket=%s source=jira", singleID)
         matching = [s for s in attachments if config['base_url'] + "/secure/attachment" in s]
         attachment = str(matching[0]).split("'")
         filename = attachment[3].rsplit(config['ticketStartString'], 1)[-1]
         download(attachment[3], singleID, filename)
     elif any("https://drive.google.com/file/d/" in s for s in attachments):
-        print("Downloading " + singleID + " from google drive")
+        log.info("downloading ticket=%s source=gdrive", singleID)
         matching = [s for s in attachments if "https://drive.google.com/file/d/" in s]
         attachment = str(str(matching[0]).split("'"))
         start = "https://drive.google.com/file/d/"
@@ -188,26 +206,26 @@ def printIsNoGo(singleIssue, singleID):
 def printIsGoodToGo(singleIssue, singleID, classKey):
     attachments = str(singleIssue).split(',')
     if any(config['base_url'] + "/secure/attachment" in s for s in attachments):
-        print("Downloading " + singleID)
+        log.info("downloading ticket=%s source=jira", singleID)
         matching = [s for s in attachments if config['base_url'] + "/secure/attachment" in s]
         attachment = str(matching[0]).split("'")
         filename = attachment[3].rsplit('EHSL3DPR-', 1)[-1]
         download(attachment[3], singleID, filename)
         if validateClassKey(classKey, 5, 1) == "Valid key":
-            print("Skip payment, they had a valid class key")
+            log.info("payment skipped ticket=%s reason=class_key", singleID)
         else:
-            print("payment")
+            log.info("payment required ticket=%s", singleID)
     elif any("https://drive.google.com/file/d/" in s for s in attachments):
-        print("Downloading " + singleID + " from google drive")
+        log.info("downloading ticket=%s source=gdrive", singleID)
         matching = [s for s in attachments if "https://drive.google.com/file/d/" in s]
         attachment = str(str(matching[0]).split("'"))
         start = "https://drive.google.com/file/d/"
         end = "/view?usp=sharing"
         downloadGoogleDrive(attachment[attachment.find(start)+len(start):attachment.rfind(end)], singleID)
         if validateClassKey(classKey, 5, 1) == "Valid key":
-            print("Skip payment, they had a valid class key")
+            log.info("payment skipped ticket=%s reason=class_key", singleID)
         else:
-            print("payment")
+            log.info("payment required ticket=%s", singleID)
     else:
         commentStatus(
             singleID,
@@ -263,7 +281,9 @@ def changeStatus(singleID, id):
         }
     }
     
-    response = requests.request(
+    response = metrics.request(
+        "jira",
+        "transition",
         "POST",
         url,
         headers=headers,
@@ -283,7 +303,9 @@ def commentStatus(singleID, comment):
         "body": comment
     }
 
-    response = requests.request(
+    response = metrics.request(
+       "jira",
+       "comment",
        "POST",
        url,
        json=payload,
@@ -292,15 +314,17 @@ def commentStatus(singleID, comment):
     )
 
 ### When someone asks what their print status if we reply ###
+@metrics.timeJob
 def askedForStatus():
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print("Checking for status updates...")
+    log.info("checking for status updates")
     url = config['base_url'] + "/rest/api/2/" + config['printing_url']
     headers = {
        "Accept": "application/json"
     }
     
-    response = requests.request(
+    response = metrics.request(
+       "jira",
+       "search",
        "GET",
        url,
        headers=headers,
@@ -315,7 +339,9 @@ def askedForStatus():
            "Accept": "application/json"
         }
         
-        response = requests.request(
+        response = metrics.request(
+           "jira",
+           "issue",
            "GET",
            url,
            headers=headers,
@@ -324,42 +350,36 @@ def askedForStatus():
 
         ticketID = url[url.find("issue/")+len("issue/"):url.rfind("")]
         singleIssue = json.loads(json.dumps(json.loads(response.text), sort_keys=True, indent=4, separators=(",", ": ")))
-        comment = singleIssue['fields']['comment']['comments'][-1]['body']
+        lastComment = singleIssue['fields']['comment']['comments'][-1]
+        # our own replies and start messages mention "status update" too, only people asking get an answer
+        if (lastComment.get('author') or {}).get('name') == config['jira_user']:
+            continue
+        comment = lastComment['body']
         for trigger in config['requestUpdate']:
             if str(comment).find(trigger) != -1:
-                print(comment)
-                directory = r'jiradownloads'
-                for filename in sorted(os.listdir(directory)):
-                    if filename.find(ticketID):
-                        commentStatus(ticketID, config["messages"]["statusInQueue"])
-                for printer in printers['farm_printers']:
-                    apikey = printers['farm_printers'][printer]['api']
-                    printerIP = printers['farm_printers'][printer]['ip']
-                    
-                    url = "http://" + printerIP + "/api/job"
+                log.info("status requested ticket=%s", ticketID)
+                commentStatus(ticketID, statusReply(ticketID))
+                # one reply per ticket even if the comment matches more than one trigger
+                break
 
-                    headers = {
-                        "Accept": "application/json",
-                        "Host": printerIP,
-                        "X-Api-Key": apikey
-                    }
-                    try:
-                        response = requests.request(
-                            "GET",
-                            url,
-                            headers=headers
-                        )
-                        status = json.loads(json.dumps(json.loads(response.text), sort_keys=True, indent=4, separators=(",", ": ")))
-                        if str(status['job']['file']['name']).find(ticketID) != -1:
-                            base = config['messages']['statusUpdate'] + "\n"
-                            completion = "Completion: " + str(round(status['progress']['completion'], 2)) + "%" + "\n"
-                            eta = "Print time left: " + str(time.strftime('%H:%M:%S', time.gmtime(status['progress']['printTimeLeft']))) + "\n"
-                            material = "Cost: $" + str(round(status['job']['filament']['tool0']['volume'] * printers['farm_printers'][printer]['materialDensity'] * config['payment']['costPerGram'],2)) + "\n"
-                            end =  config['messages']['statusUpdateEnd']
-                            
-                            printerStatusUpdate = base + completion + eta + material + end
-                            commentStatus(ticketID, printerStatusUpdate)
-                            print(printerStatusUpdate)
-                    except requests.exceptions.RequestException as e:  # This is the correct syntax
-                        print("Skipping " + printer + " due to network error.")
-                return
+### build the status reply for a ticket from the farm index, no printers are polled here ###
+def statusReply(ticketID):
+    state, printer, status = farmstate.lookup(ticketID)
+    if state == "queued":
+        return config["messages"]["statusInQueue"]
+    if state is None:
+        return config["messages"]["statusNotFound"]
+    if status is None:
+        # the ticket is on a printer but its pi didn't answer the last poll
+        return config["messages"]["printStarted"]
+    base = config['messages']['statusUpdate'] + "\n"
+    completion = "Completion: " + str(round(status['progress']['completion'] or 0, 2)) + "%" + "\n"
+    eta = "Print time left: " + str(time.strftime('%H:%M:%S', time.gmtime(status['progress']['printTimeLeft'] or 0))) + "\n"
+    # octoprint sends filament as null while it is still analysing a fresh upload, leave the cost out until it's known
+    tool0 = (status['job'].get('filament') or {}).get('tool0') or {}
+    material = ""
+    if tool0.get('volume') is not None:
+        material = "Cost: $" + str(round(tool0['volume'] * printers['farm_printers'][printer]['materialDensity'] * config['payment']['costPerGram'],2)) + "\n"
+    end =  config['messages']['statusUpdateEnd']
+    log.info("status sent ticket=%s printer=%s", ticketID, printer)
+    return base + completion + eta + material + end
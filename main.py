@@ -2,23 +2,33 @@ import jira
 import schedule
 import time
 import octoprint
+import metrics
+import health
+import logging
 import yaml
 
 with open("config.yml", "r") as yamlfile:
     config = yaml.load(yamlfile, Loader=yaml.FullLoader)
 
+metrics.setupLogging()
+log = logging.getLogger("main")
 
 ### we start the services from the start ###
 jira.getGcode()
 octoprint.eachNewFile()
 octoprint.PrintIsFinished()
+metrics.dump()
+health.dump()
 
 ### Then the system loops the schedules functions ###
-print("PRINT MONITORING SYSTEM LOOP STARTED")
+log.info("print monitoring system loop started")
 schedule.every(config['updateRate']).minutes.do(jira.getGcode)
 schedule.every(config['updateRate']).minutes.do(octoprint.eachNewFile)
 schedule.every(config['updateRate']).minutes.do(octoprint.PrintIsFinished)
 schedule.every(config['updateRate']).minutes.do(jira.askedForStatus)
+# registered last so they run after the other jobs in the same tick, the snapshots then mark when a tick finished
+schedule.every(config['updateRate']).minutes.do(metrics.dump)
+schedule.every(config['updateRate']).minutes.do(health.dump)
 
 while 1:
     schedule.run_pending()
@@ -0,0 +1,155 @@
+import os
+import time
+import logging
+import functools
+import threading
+import requests
+
+### Farm instrumentation: a small in-process metrics registry rendered in the prometheus text format ###
+### main.py and app.py run as two processes, so the farm loop dumps its registry to SNAPSHOT every tick and app.py serves that file ###
+SNAPSHOT = "./metrics.prom"
+
+### latency buckets in seconds, jira and the pis can both take a while so these go up to a minute ###
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS = {
+    "farm_http_request_duration_seconds": ("histogram", "Latency of every Jira, OctoPrint and Google Drive call."),
+    "farm_bytes_downloaded_total": ("counter", "Bytes received from an external service."),
+    "farm_bytes_uploaded_total": ("counter", "Bytes sent to an external service."),
+    "farm_job_duration_seconds": ("histogram", "Duration of each scheduler job."),
+    "farm_job_failures_total": ("counter", "Scheduler jobs that raised an exception."),
+    "farm_queue_depth": ("gauge", "G-code files waiting in jiradownloads."),
+    "farm_printers": ("gauge", "Printers in each state as of the last harvest pass."),
+    "farm_printer_utilization_ratio": ("gauge", "Share of the farm that was printing as of the last harvest pass."),
+    "farm_printer_up": ("gauge", "1 while a printer's circuit breaker is closed, 0 while it is down and backing off."),
+    "farm_printer_consecutive_failures": ("gauge", "Failed requests in a row for each printer."),
+    "farm_last_tick_timestamp_seconds": ("gauge", "Unix time the farm loop last finished a tick."),
+}
+
+_lock = threading.Lock()
+_values = {name: {} for name in METRICS}
+
+log = logging.getLogger("metrics")
+
+### structured key=value logging for the farm loop, replaces the old print and clear screen output ###
+def setupLogging(level=logging.INFO):
+    logging.basicConfig(
+        level=level,
+        format="ts=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s"
+    )
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+### add to a counter ###
+def inc(name, value=1, **labels):
+    with _lock:
+        series = _values[name]
+        key = _key(labels)
+        series[key] = series.get(key, 0) + value
+
+### set a gauge to an exact value ###
+def setGauge(name, value, **labels):
+    with _lock:
+        _values[name][_key(labels)] = value
+
+### drop every series of a gauge, used when the label set changes between passes ###
+def clearGauge(name):
+    with _lock:
+        _values[name].clear()
+
+### record one sample in a histogram ###
+def observe(name, value, **labels):
+    with _lock:
+        series = _values[name]
+        key = _key(labels)
+        if key not in series:
+            series[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        hist = series[key]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                hist["buckets"][i] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+### decorator that records how long a scheduler job takes ###
+def timeJob(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            inc("farm_job_failures_total", job=func.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            observe("farm_job_duration_seconds", elapsed, job=func.__name__)
+            log.info("job=%s duration=%.3f", func.__name__, elapsed)
+    return wrapper
+
+### drop in for requests.request that records latency and bytes for the service and endpoint ###
+def request(service, endpoint, method, url, **kwargs):
+    start = time.perf_counter()
+    status = "error"
+    try:
+        response = requests.request(method, url, **kwargs)
+        status = str(response.status_code)
+        inc("farm_bytes_downloaded_total", len(response.content), service=service)
+        body = response.request.body
+        if body:
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            inc("farm_bytes_uploaded_total", len(body), service=service)
+        return response
+    finally:
+        observe(
+            "farm_http_request_duration_seconds",
+            time.perf_counter() - start,
+            service=service,
+            endpoint=endpoint,
+            status=status
+        )
+
+def _formatLabels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = []
+    for label, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(label + '="' + value + '"')
+    return "{" + ",".join(escaped) + "}"
+
+def _formatNumber(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+### render the whole registry in the prometheus text exposition format ###
+def render():
+    lines = []
+    with _lock:
+        for name, (kind, text) in METRICS.items():
+            series = _values[name]
+            lines.append("# HELP " + name + " " + text)
+            lines.append("# TYPE " + name + " " + kind)
+            for key in sorted(series):
+                value = series[key]
+                if kind == "histogram":
+                    for bound, count in zip(BUCKETS, value["buckets"]):
+                        lines.append(name + "_bucket" + _formatLabels(key, [("le", _formatNumber(bound))]) + " " + str(count))
+                    lines.append(name + "_bucket" + _formatLabels(key, [("le", "+Inf")]) + " " + str(value["count"]))
+                    lines.append(name + "_sum" + _formatLabels(key) + " " + _formatNumber(value["sum"]))
+                    lines.append(name + "_count" + _formatLabels(key) + " " + str(value["count"]))
+                else:
+                    lines.append(name + _formatLabels(key) + " " + _formatNumber(value))
+    return "\n".join(lines) + "\n"
+
+### write the registry out so the flask app can serve it, replace so a scrape never sees half a file ###
+def dump(path=SNAPSHOT):
+    setGauge("farm_last_tick_timestamp_seconds", time.time())
+    temp = path + ".tmp"
+    with open(temp, "w") as f:
+        f.write(render())
+    os.replace(temp, path)
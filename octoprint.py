@@ -6,6 +6,13 @@ import yaml
 import jira
 import os
 import time
+import logging
+import sqlite3
+import metrics
+import history
+import farmstate
+import health
+import receipt
 from datetime import datetime
 
 ### importing confits ###
@@ -14,6 +21,8 @@ with open("config.yml", "r") as yamlfile:
 with open("printers.yml", "r") as yamlfile:
     printers = yaml.load(yamlfile, Loader=yaml.FullLoader)
 
+log = logging.getLogger("octoprint")
+
 ### This will look at the prints we have waiting and see if a printer is open for it ###
 def TryPrintingFile(file):
     for printer in printers['farm_printers']:
@@ -23,6 +32,8 @@ def TryPrintingFile(file):
         materialColor = printers['farm_printers'][printer]['materialColor']
         materialDensity = printers['farm_printers'][printer]['materialDensity']
         printerType = printers['farm_printers'][printer]['printerType']
+        if not health.allow(apikey, printer):
+            continue
         
         url = "http://" + printerIP + "/api/job"
 
@@ -32,19 +43,36 @@ def TryPrintingFile(file):
             "X-Api-Key": apikey
         }
         try:
-            response = requests.request(
+            response = metrics.request(
+                "octoprint",
+                "job",
                 "GET",
                 url,
-                headers=headers
+                headers=headers,
+                timeout=config.get('printerTimeout', 5)
             )
             status = json.loads(json.dumps(json.loads(response.text), sort_keys=True, indent=4, separators=(",", ": ")))
-            if str(status['state']) == "Operational" and str(status['progress']['completion']) != "100.0":
-                uploadFileToPrinter(apikey, printerIP, file)
-                return
         except requests.exceptions.RequestException as e:  # This is the correct syntax
-            print("Skipping " + printer + " due to network error")
-            print("code needed to reboot printer is it's having this issue")
-### Get the status of the printer you are asking about ###
+            health.failure(apikey, type(e).__name__)
+            log.warning("skipping printer=%s reason=network_error", printer)
+            continue
+        except ValueError:
+            health.failure(apikey, "bad_response")
+            log.warning("skipping printer=%s reason=bad_response", printer)
+            continue
+        health.success(apikey)
+        farmstate.printerStatus(printer, status)
+        if str(status['state']) == "Operational" and str(status['progress']['completion']) != "100.0":
+            # only the upload itself can fail the printer, the file stays queued for the next one
+            try:
+                uploadFileToPrinter(apikey, printerIP, file)
+            except requests.exceptions.RequestException as e:
+                health.failure(apikey, type(e).__name__)
+                log.warning("upload failed printer=%s file=%s reason=%s", printer, file, type(e).__name__)
+                continue
+            farmstate.dispatched(file, printer)
+            return
+### Get the status of the printer you are asking about, the dashboard checks the farm loop's health snapshot before calling this ###
 def GetStatus(ip, api):
     apikey = api
     printerIP = ip
@@ -56,17 +84,22 @@ def GetStatus(ip, api):
         "X-Api-Key": apikey
     }
     try:
-        response = requests.request(
+        response = metrics.request(
+            "octoprint",
+            "job",
             "GET",
             url,
-            headers=headers
+            headers=headers,
+            timeout=config.get('printerTimeout', 5)
         )
         status = json.loads(json.dumps(json.loads(response.text), sort_keys=True, indent=4, separators=(",", ": ")))
         return status
     except requests.exceptions.RequestException as e:  # This is the correct syntax
-        print(printerIP + "'s raspberry pi is offline and can't be contacted over the network")
+        log.warning("printer offline ip=%s", printerIP)
         status = "offline"
         return status
+    except ValueError:
+        return "offline"
 ### get the name of the printer you are asking about ###
 def GetName(ip, api):
     apikey = api
@@ -78,75 +111,30 @@ def GetName(ip, api):
         "Host": printerIP,
         "X-Api-Key": apikey
     }
+    if not health.allow(apikey):
+        return name
     try:
-        response = requests.request(
+        response = metrics.request(
+            "octoprint",
+            "printerprofiles",
             "GET",
             url,
-            headers=headers
+            headers=headers,
+            timeout=config.get('printerTimeout', 5)
         )
         status = json.loads(json.dumps(json.loads(response.text), sort_keys=True, indent=4, separators=(",", ": ")))
+        health.success(apikey)
 
         name = status["profiles"]["_default"]["name"]
         return name
     except requests.exceptions.RequestException as e:  # This is the correct syntax
-        print(printerIP + "'s raspberry pi is offline and can't be contacted over the network")
+        health.failure(apikey, type(e).__name__)
+        log.warning("printer offline ip=%s", printerIP)
         status = "offline"
         return name
-### probably shouldn't be in the octoprint file but this gets the receipt printer stuff ###
+### queue a receipt for the receipt printer worker, see receipt.py ###
 def receiptPrinter(scrapedprNumber, ticketNumber, scrapedPatronName, printer=''):
-    from PIL import Image, ImageDraw, ImageFont, ImageOps
-    from escpos.printer import Usb
-
-    patronName = scrapedPatronName
-    try:
-        patronName = str(patronName)
-        patronName = patronName.title()
-    except:
-        patronName = ''
-
-    if len(patronName) > 0:
-        firstName = patronName.split(' ')[0]
-        lastName = patronName.split(' ')[-1]
-        if firstName != lastName:
-            patronName = firstName[0] + ', ' + lastName
-
-    try:
-        # try to reconnect to printer
-        p = Usb(0x0416, 0x5011, 0, 0x81, 0x03)
-    except:
-        alreadyConnected = True
-    try:
-        # try to center printing alignment
-        p.set(align='center')
-    except:
-        alreadyAligned = True
-    # create new image large enough to fit super long names
-    img = Image.new('RGB', (2400, 400), color=(0, 0, 0))
-    fnt = ImageFont.truetype(r"recources/arialbd.ttf", 110, encoding="unic")
-    tiny = ImageFont.truetype(r"recources/arial.ttf", 20, encoding="unic")
-    d = ImageDraw.Draw(img)
-    d.text((32, 0), scrapedprNumber, font=fnt, fill=(255, 255, 255))
-    firstFew = patronName[:8]
-    if 'y' in firstFew or 'g' in firstFew or 'p' in firstFew or 'q' in firstFew:
-        d.text((32, 121), patronName, font=fnt, fill=(255, 255, 255))
-    else:
-        d.text((32, 128), patronName, font=fnt, fill=(255, 255, 255))
-    d.text((32, 256), ticketNumber, font=fnt, fill=(255, 255, 255))
-    d.text((34, 355), printer, font=tiny, fill=(255, 255, 255))
-
-    imageBox = img.getbbox()
-    cropped = img.crop(imageBox)
-    inverted = ImageOps.invert(cropped)
-    rotated = inverted.rotate(270, expand=True)
-
-    try:
-        # print image
-        p.image(rotated)
-        # cut point
-        p.text("\n\n-                              -\n\n")
-    except:
-        print("\nThe receipt printer is unplugged or not powered on, please double check physical connections.")
-        raise ValueError
+    receipt.submit(scrapedprNumber, ticketNumber, scrapedPatronName, printer)
 ### Uploads a file to a printer ###
 def uploadFileToPrinter(apikey, printerIP, file):
     openFile = open('jiradownloads/' + file + '.gcode', 'rb')
@@ -154,7 +142,11 @@ def uploadFileToPrinter(apikey, printerIP, file):
     url = "http://" + printerIP + "/api/files/{}".format("local")
     payload = {'select': 'true', 'print': 'true'}
     header = {'X-Api-Key': apikey}
-    response = requests.post(url, files=fle, data=payload, headers=header)
+    try:
+        response = metrics.request("octoprint", "files", "POST", url, files=fle, data=payload, headers=header, timeout=config.get('printerTimeout', 5))
+        response.raise_for_status()
+    finally:
+        openFile.close()
 
     if os.path.exists("jiradownloads/" + file + ".gcode"):
         # print(config['Save_printed_files'])
@@ -162,29 +154,31 @@ def uploadFileToPrinter(apikey, printerIP, file):
             os.remove("jiradownloads/" + file + ".gcode")
         else:
             os.replace("jiradownloads/" + file + ".gcode", "archive_files/" + file + ".gcode")
-        if ticketText != config['messages']['printStarted']:
-            # filenamerefrenced
-            jira.commentStatus(file, ticketText)
-        printerName = GetName(printerIP, apikey)
-        print("Now printing: " + file + " on " + printerName + " at " + printerIP)
-        
-    if config["reciept_printer"]["print_physical_reciept"] == True:
+        # the print has started, nothing after this may raise back into dispatch and upload the file again
         try:
+            # filenamerefrenced
+            jira.commentStatus(file, config['messages']['printStarted'])
             printerName = GetName(printerIP, apikey)
-            receiptPrinter(projectNumber, ticketNumber, patronName, printerName)
-        except:
-            print("There was a problem printing the receipt " + projectNumber)
+            log.info("now printing file=%s printer=%s ip=%s", file, printerName, printerIP)
+
+            if config["reciept_printer"]["print_physical_reciept"] == True:
+                ticketNumber = farmstate.ticketOf(file)
+                receiptPrinter(ticketNumber.rsplit('-', 1)[-1], ticketNumber, '', printerName)
+        except Exception:
+            log.exception("print started but could not be announced file=%s ip=%s", file, printerIP)
 ### Resets the connection to a printer, done as a safety check and status clear ###
 def resetConnection(apikey, printerIP):
     url = "http://" + printerIP + "/api/connection"
     disconnect = {'command': 'disconnect'}
     connect = {'command': 'connect'}
     header = {'X-Api-Key': apikey}
-    response = requests.post(url, json=disconnect, headers=header)
-    time.sleep(30)
-    response = requests.post(url, json=connect, headers=header)
+    response = metrics.request("octoprint", "connection", "POST", url, json=disconnect, headers=header, timeout=config.get('printerTimeout', 5))
+    time.sleep(config.get('resetConnectionDelay', 30))
+    response = metrics.request("octoprint", "connection", "POST", url, json=connect, headers=header, timeout=config.get('printerTimeout', 5))
 ### If a print is complete update people and mark as ready for new file ###
+@metrics.timeJob
 def PrintIsFinished():
+    states = {}
     for printer in printers['farm_printers']:
         apikey = printers['farm_printers'][printer]['api']
         printerIP = printers['farm_printers'][printer]['ip']
@@ -194,35 +188,56 @@ def PrintIsFinished():
             "Host": printerIP,
             "X-Api-Key": apikey
         }
+        # a printer whose breaker is open isn't polled until its backoff is over
+        if not health.allow(apikey, printer):
+            farmstate.printerStatus(printer, "offline")
+            states["Down"] = states.get("Down", 0) + 1
+            continue
         try:
-            response = requests.request(
+            response = metrics.request(
+                "octoprint",
+                "job",
                 "GET",
                 url,
-                headers=headers
+                headers=headers,
+                timeout=config.get('printerTimeout', 5)
             )
             if("State" not in response.text):
                 if (json.loads(json.dumps(json.loads(response.text), sort_keys=True, indent=4, separators=(",", ": ")))):
                     status = json.loads(json.dumps(json.loads(response.text), sort_keys=True, indent=4, separators=(",", ": ")))
+                    health.success(apikey)
                 else:
                     status = "offline"
+                    health.failure(apikey, "empty_response")
             else:
-                print(printer + " is having issues and the pi is un-reachable, if this continues restart the pi")
+                log.warning("printer unreachable printer=%s hint=restart_the_pi", printer)
                 status = "offline"
+                health.failure(apikey, "octoprint_error")
         except requests.exceptions.RequestException as e:  # This is the correct syntax
-            print(printer + "'s raspberry pi is offline and can't be contacted over the network")
+            log.warning("printer offline printer=%s", printer)
             status = "offline"
+            health.failure(apikey, type(e).__name__)
 
         """
         I might want to change some of this code when I am in front of the printers to make it so each printers status get's printed out
         """
+        farmstate.printerStatus(printer, status)
+        state = "Offline" if status == "offline" else str(status['state'])
+        states[state] = states.get(state, 0) + 1
         if status != "offline":
             if status['state'] == "Operational":
                 if str(status['progress']['completion']) == "100.0":
                     volume = status['job']['filament']['tool0']['volume']
                     grams = volume * printers['farm_printers'][printer]['materialDensity']
-                    print(printer + " is finishing up")
+                    log.info("harvesting printer=%s grams=%.2f", printer, grams)
                     file = os.path.splitext(status['job']['file']['display'])[0]
-                    resetConnection(apikey, printerIP)
+                    try:
+                        resetConnection(apikey, printerIP)
+                    except requests.exceptions.RequestException as e:
+                        # nothing is recorded yet, the harvest is retried once the printer answers again
+                        health.failure(apikey, type(e).__name__)
+                        log.warning("harvest failed printer=%s reason=%s", printer, type(e).__name__)
+                        continue
                     try:
                         response = "{color:#00875A}Print completed successfully!{color}\n\nPrint was harvested at "
                         response += "Filament Usage ... " + str(grams) + "g"
@@ -232,22 +247,45 @@ def PrintIsFinished():
                         response += cost + " " + config["messages"]["finalMessage"]
                         jira.commentStatus(file, response)
                     except FileNotFoundError:
-                        print("This print was not started by this script, I am ignoring it: " + file)
+                        log.warning("ignoring print not started by the farm file=%s", file)
                     jira.changeStatus(file, "21")  # filenamerefrenced
                     jira.changeStatus(file, "31")  # filenamerefrenced
                     if config['payment']['prepay'] == True:
                         jira.changeStatus(file, "41")  # filenamerefrenced
+                    # only once the harvest went through, a failed harvest is retried next tick and would count twice
+                    material = printers['farm_printers'][printer].get('materialType', printers['farm_printers'][printer].get('materialName', 'unknown'))
+                    # the display name can be "<attachment>__<ticket>", history is keyed by the ticket alone
+                    ticket = file.rsplit('__', 1)[-1]
+                    try:
+                        history.record(printer, material, ticket, grams, grams * config["payment"]["costPerGram"], status['progress'].get('printTime') or 0, status['job']['file'].get('date') or 0)
+                    except sqlite3.Error:
+                        log.exception("could not record print history file=%s", file)
+                    farmstate.harvested(file)
                 else:
-                    print(printer + " is ready")
+                    log.debug("printer=%s state=ready", printer)
                     continue
             elif status['state'] == "Printing":
-                print(printer + " is printing")
+                log.debug("printer=%s state=printing", printer)
             else:
-                print(printer + " is offline")
+                log.debug("printer=%s state=%s", printer, status['state'])
+
+    for printer in printers['farm_printers']:
+        apikey = printers['farm_printers'][printer]['api']
+        metrics.setGauge("farm_printer_up", 1 if health.isUp(apikey) else 0, printer=printer)
+        metrics.setGauge("farm_printer_consecutive_failures", health.printers[apikey]["failures"], printer=printer)
+    metrics.clearGauge("farm_printers")
+    for state in states:
+        metrics.setGauge("farm_printers", states[state], state=state)
+    if len(printers['farm_printers']) > 0:
+        metrics.setGauge("farm_printer_utilization_ratio", states.get("Printing", 0) / len(printers['farm_printers']))
 
 ### for each file in the list see if a printer is open for it ###
+@metrics.timeJob
 def eachNewFile():
     directory = r'jiradownloads'
+    queue = [f for f in os.listdir(directory) if f.endswith(".gcode")]
+    metrics.setGauge("farm_queue_depth", len(queue))
+    farmstate.syncQueue(queue)
     for filename in sorted(os.listdir(directory)):
         if filename.endswith(".gcode"):
             TryPrintingFile(os.path.splitext(filename)[0])
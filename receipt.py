@@ -0,0 +1,204 @@
+import os
+import ast
+import time
+import queue
+import logging
+import threading
+import yaml
+
+### Receipt printing off the dispatch path: uploads queue a job and a background worker renders and prints it ###
+# The worker keeps the fonts and the USB handle open between receipts, renders straight into a tight 1-bit
+# image instead of a 2400x400 RGB canvas, and retries a job while the printer is unplugged.
+
+with open("config.yml", "r") as yamlfile:
+    config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+
+settings = config.get('reciept_printer') or {}
+BACKEND = settings.get('backend', 'usb')
+OUTPUT = settings.get('output', './receipts')
+RETRIES = settings.get('retries', 5)
+RETRY_DELAY = settings.get('retryDelay', 10)
+BACKENDS = ('usb', 'file', 'null')
+
+FONT = "recources/arialbd.ttf"
+TINY_FONT = "recources/arial.ttf"
+CUT = "\n\n-                              -\n\n"
+
+log = logging.getLogger("receipt")
+
+if BACKEND not in BACKENDS:
+    log.error("unknown receipt printer backend=%s, expected one of %s, receipts will not print", BACKEND, ", ".join(BACKENDS))
+
+jobs = queue.Queue()
+_worker = None
+_workerLock = threading.Lock()
+
+def _loadFont(path, size):
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype(path, size, encoding="unic")
+    except OSError:
+        log.warning("font missing path=%s, using the pillow default", path)
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:
+            return ImageFont.load_default()
+
+### the receipt layout with its fonts loaded once ###
+class Template:
+    def __init__(self):
+        self.font = _loadFont(FONT, 110)
+        self.tiny = _loadFont(TINY_FONT, 20)
+
+    ### the same four lines the old receipt had, rendered black on white at the final rotated orientation ###
+    def render(self, prNumber, patronName, ticketNumber, printer=''):
+        from PIL import Image, ImageDraw
+        # names with descenders in the first few letters sit a little higher so they don't touch the ticket number
+        nameTop = 121 if any(letter in patronName[:8] for letter in 'ygpq') else 128
+        lines = [
+            ((32, 0), prNumber, self.font),
+            ((32, nameTop), patronName, self.font),
+            ((32, 256), ticketNumber, self.font),
+            ((34, 355), printer, self.tiny),
+        ]
+        lines = [line for line in lines if line[1]]
+        if not lines:
+            return Image.new('1', (1, 1), 1)
+        boxes = []
+        for (x, y), text, font in lines:
+            left, top, right, bottom = font.getbbox(text)
+            boxes.append((x + left, y + top, x + right, y + bottom))
+        left = min(box[0] for box in boxes)
+        top = min(box[1] for box in boxes)
+        right = max(box[2] for box in boxes)
+        bottom = max(box[3] for box in boxes)
+        img = Image.new('1', (right - left, bottom - top), 1)
+        d = ImageDraw.Draw(img)
+        for (x, y), text, font in lines:
+            d.text((x - left, y - top), text, font=font, fill=0)
+        # a 1-bit transpose is a lossless pixel shuffle, same result as the old rotate(270, expand=True)
+        return img.transpose(Image.Transpose.ROTATE_270)
+
+### the usb thermal printer, the handle stays open until a print fails ###
+class UsbBackend:
+    def __init__(self, ids):
+        self.ids = ids
+        self.printer = None
+
+    def print(self, image, job):
+        from escpos.printer import Usb
+        if self.printer is None:
+            self.printer = Usb(*self.ids)
+            self.printer.set(align='center')
+        try:
+            self.printer.image(image)
+            self.printer.text(CUT)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.printer is not None:
+            try:
+                self.printer.close()
+            except Exception:
+                pass
+            self.printer = None
+
+### writes each receipt to a png, for testing the layout without the printer ###
+class FileBackend:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def print(self, image, job):
+        os.makedirs(self.directory, exist_ok=True)
+        image.save(os.path.join(self.directory, job["ticketNumber"] + ".png"))
+
+    def close(self):
+        pass
+
+### renders and throws the receipt away, keeps the last few around so they can be checked ###
+class NullBackend:
+    def __init__(self):
+        self.printed = []
+
+    def print(self, image, job):
+        self.printed.append((job, image.size))
+        del self.printed[:-100]
+
+    def close(self):
+        pass
+
+def makeBackend(name=None):
+    name = name or BACKEND
+    if name == 'usb':
+        return UsbBackend(ast.literal_eval(settings.get('ID', "(0x0416, 0x5011, 0, 0x81, 0x03)")))
+    if name == 'file':
+        return FileBackend(OUTPUT)
+    if name == 'null':
+        return NullBackend()
+    raise ValueError("unknown receipt printer backend: " + str(name))
+
+### format the patron name the way the desk expects, "F, Last" ###
+def formatName(scrapedPatronName):
+    try:
+        patronName = str(scrapedPatronName).title()
+    except Exception:
+        patronName = ''
+    if len(patronName) > 0:
+        firstName = patronName.split(' ')[0]
+        lastName = patronName.split(' ')[-1]
+        if firstName != lastName:
+            patronName = firstName[0] + ', ' + lastName
+    return patronName
+
+### background loop: one job at a time, a failed print is retried with a growing delay before it is dropped ###
+def work(backend=None, stop=None):
+    # the backend and fonts are set up here on the worker thread so a bad config can't raise into dispatch
+    try:
+        backend = backend or makeBackend()
+        template = Template()
+    except Exception:
+        log.exception("receipt worker could not start")
+        return
+    while stop is None or not stop.is_set():
+        try:
+            job = jobs.get(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            image = template.render(job["prNumber"], formatName(job["patronName"]), job["ticketNumber"], job["printer"])
+        except Exception:
+            log.exception("receipt could not be rendered ticket=%s", job["ticketNumber"])
+            jobs.task_done()
+            continue
+        for attempt in range(RETRIES + 1):
+            try:
+                backend.print(image, job)
+                log.info("receipt printed ticket=%s", job["ticketNumber"])
+                break
+            except Exception as e:
+                if attempt == RETRIES:
+                    log.error("receipt dropped ticket=%s after attempts=%s reason=%s", job["ticketNumber"], attempt + 1, type(e).__name__)
+                    break
+                delay = RETRY_DELAY * (2 ** attempt)
+                log.warning("receipt printer unplugged or not powered on ticket=%s retry_in=%ss reason=%s", job["ticketNumber"], delay, type(e).__name__)
+                time.sleep(delay)
+        jobs.task_done()
+
+### start the worker thread once per process ###
+def start(backend=None):
+    global _worker
+    with _workerLock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=work, args=(backend,), name="receipt-printer", daemon=True)
+            _worker.start()
+    return _worker
+
+### queue a receipt, never blocks or raises into the caller ###
+def submit(prNumber, ticketNumber, patronName, printer=''):
+    try:
+        start()
+        jobs.put({"prNumber": str(prNumber), "ticketNumber": str(ticketNumber), "patronName": patronName, "printer": printer})
+    except Exception:
+        log.exception("receipt could not be queued ticket=%s", ticketNumber)
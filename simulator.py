@@ -0,0 +1,415 @@
+import os
+import re
+import sys
+import json
+import base64
+import time
+import random
+import shutil
+import tempfile
+import importlib
+import threading
+from email import policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+import yaml
+
+### In-process fake Jira and OctoPrint servers so the control loop can be driven on one box without real Pis ###
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TICKET_PREFIX = "EHSL3DPR-"
+GOOD_GCODE = "; generated by the farm simulator\nG28\nM1\n; EHSL\nG1 X10 Y10\n"
+
+### jira transition ids from jira.changeStatus mapped to the status they move the ticket to ###
+TRANSITIONS = {
+    "11": "In Progress",
+    "21": "Under Review",
+    "31": "Approved",
+    "41": "Done",
+    "111": "Cancelled",
+    "121": "Open",
+    "131": "Rejected",
+    "141": "In Progress",
+}
+
+### shared request handler, each fake gives it a route(method, path, query, headers, body) callback ###
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        parsed = urlparse(self.path)
+        result = self.fake.route(method, parsed.path, parse_qs(parsed.query), self.headers, body)
+        if result is None:
+            # simulate a pi that drops off the network, requests sees a ConnectionError
+            self.close_connection = True
+            return
+        code, payload = result
+        if isinstance(payload, (dict, list)):
+            data = json.dumps(payload).encode("utf-8")
+            contentType = "application/json"
+        else:
+            data = payload.encode("utf-8") if isinstance(payload, str) else payload
+            contentType = "text/plain"
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+### base class that owns the http server thread, the request counter and the latency and failure knobs ###
+class _FakeServer:
+    def __init__(self, latency=0.0, failureRate=0.0, seed=0):
+        self.latency = latency
+        self.failureRate = failureRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = None
+
+    def start(self):
+        handler = type(type(self).__name__ + "Handler", (_Handler,), {"fake": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def address(self):
+        return "127.0.0.1:" + str(self.server.server_address[1])
+
+    def route(self, method, path, query, headers, body):
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.failureRate
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if failed:
+            return self.failure()
+        return self.dispatch(method, path, query, headers, body)
+
+    def failure(self):
+        return None
+
+### fake jira rest api: search, issue, attachment, transitions and comments ###
+class FakeJira(_FakeServer):
+    def __init__(self, tickets=100, pageSize=50, badRate=0.0, **kwargs):
+        _FakeServer.__init__(self, **kwargs)
+        self.pageSize = pageSize
+        self.issues = {}
+        now = time.time()
+        for number in range(1, tickets + 1):
+            key = TICKET_PREFIX + str(number)
+            self.issues[key] = {
+                "status": "Open",
+                "reporter": "u" + str(number).zfill(7),
+                "created": now,
+                "bad": self.random.random() < badRate,
+                "comments": [],
+            }
+
+    def failure(self):
+        return 503, "Service Unavailable"
+
+    def issueJson(self, key):
+        issue = self.issues[key]
+        base = "http://" + self.address
+        return {
+            "key": key,
+            "self": base + "/rest/api/2/issue/" + key,
+            "fields": {
+                "attachment": [{
+                    "author": {"name": issue["reporter"]},
+                    "content": base + "/secure/attachment/" + key[len(TICKET_PREFIX):] + "/" + key + "_part.gcode",
+                    "filename": key + "_part.gcode",
+                }],
+                "comment": {"comments": [{"author": {"name": author}, "body": body} for author, body in issue["comments"]]},
+                "description": "*Class Key* \\\\\n\n*Description of print*\nsimulated part",
+                "reporter": {"name": issue["reporter"]},
+                "status": {"name": issue["status"]},
+            },
+        }
+
+    def dispatch(self, method, path, query, headers, body):
+        base = "http://" + self.address
+        if method == "GET" and path == "/rest/api/2/search":
+            jql = unquote(query.get("jql", [""])[0])
+            match = re.search(r'status\s*=\s*"?([^"]+)"?', jql)
+            wanted = match.group(1).strip() if match else None
+            start = int(query.get("startAt", ["0"])[0])
+            limit = int(query.get("maxResults", [str(self.pageSize)])[0])
+            with self.lock:
+                keys = [key for key in self.issues if wanted is None or self.issues[key]["status"] == wanted]
+            page = keys[start:start + limit]
+            return 200, {
+                "startAt": start,
+                "maxResults": limit,
+                "total": len(keys),
+                "issues": [{"key": key, "self": base + "/rest/api/2/issue/" + key} for key in page],
+            }
+        match = re.match(r"^/rest/api/2/issue/([^/]+)(/transitions|/comment)?$", path)
+        if match:
+            key = match.group(1)
+            if key not in self.issues:
+                return 404, {"errorMessages": ["Issue does not exist"]}
+            data = json.loads(body or b"{}")
+            author = self._user(headers)
+            with self.lock:
+                if method == "GET" and match.group(2) is None:
+                    return 200, self.issueJson(key)
+                if method == "POST" and match.group(2) == "/transitions":
+                    self.issues[key]["status"] = TRANSITIONS.get(str(data["transition"]["id"]), self.issues[key]["status"])
+                    for comment in data.get("update", {}).get("comment", []):
+                        self.issues[key]["comments"].append((author, comment["add"]["body"]))
+                    return 204, ""
+                if method == "POST" and match.group(2) == "/comment":
+                    self.issues[key]["comments"].append((author, data["body"]))
+                    return 201, {"body": data["body"]}
+        match = re.match(r"^/secure/attachment/(\d+)/", path)
+        if method == "GET" and match:
+            key = TICKET_PREFIX + match.group(1)
+            if self.issues[key]["bad"]:
+                return 200, "; sliced without the farm profile\nG1 X10 Y10\n"
+            return 200, GOOD_GCODE
+        return 404, {"errorMessages": ["Not found"]}
+
+    ### the user name from the basic auth header, that's who jira shows as the comment author ###
+    def _user(self, headers):
+        value = headers.get("Authorization") or ""
+        if not value.startswith("Basic "):
+            return None
+        return base64.b64decode(value[len("Basic "):]).decode("utf-8").split(":", 1)[0]
+
+    ### a student comments asking for a status update on a random share of the printing tickets ###
+    def requestStatus(self, rate, trigger="status update please"):
+        with self.lock:
+            for key in self.issues:
+                if self.issues[key]["status"] == "In Progress" and self.random.random() < rate:
+                    self.issues[key]["comments"].append((self.issues[key]["reporter"], trigger))
+
+    def countByStatus(self):
+        counts = {}
+        with self.lock:
+            for key in self.issues:
+                status = self.issues[key]["status"]
+                counts[status] = counts.get(status, 0) + 1
+        return counts
+
+### fake octoprint farm behind one port, printers are told apart by their X-Api-Key like the real config ###
+class FakeOctoPrint(_FakeServer):
+    def __init__(self, printers=5, printSeconds=60.0, dead=0, deadDelay=0.0, **kwargs):
+        _FakeServer.__init__(self, **kwargs)
+        self.printSeconds = printSeconds
+        self.deadDelay = deadDelay
+        self.started = time.time()
+        self.printers = {}
+        self.dispatched = {}
+        for number in range(1, printers + 1):
+            api = "SIM" + str(number).zfill(29)
+            self.printers[api] = {
+                "name": "printer " + str(number),
+                "dead": number <= dead,
+                "file": None,
+                "startedAt": None,
+                "duration": 0.0,
+                "busy": 0.0,
+                "files": [],
+            }
+
+    def printerConfig(self, materialDensity=1.25):
+        farm = {}
+        for api in self.printers:
+            printer = self.printers[api]
+            farm[printer["name"]] = {
+                "ip": self.address,
+                "api": api,
+                "stream": "",
+                "materialType": "pla",
+                "materialColor": "white",
+                "materialDensity": materialDensity,
+                "printerType": "simulated",
+            }
+        return {"farm_printers": farm}
+
+    def _job(self, printer, now):
+        if printer["file"] is None:
+            return {
+                "state": "Operational",
+                "job": {"file": {"name": None, "display": None}, "filament": None},
+                "progress": {"completion": None, "printTime": None, "printTimeLeft": None},
+            }
+        elapsed = now - printer["startedAt"]
+        done = elapsed >= printer["duration"]
+        return {
+            "state": "Operational" if done else "Printing",
+            "job": {
+                "file": {"name": printer["file"], "display": printer["file"], "date": int(printer["startedAt"])},
+                "filament": {"tool0": {"volume": 8.0, "length": 3300.0}},
+            },
+            "progress": {
+                "completion": 100.0 if done else round(100.0 * elapsed / printer["duration"], 2),
+                "printTime": int(min(elapsed, printer["duration"])),
+                "printTimeLeft": 0 if done else int(printer["duration"] - elapsed),
+            },
+        }
+
+    def dispatch(self, method, path, query, headers, body):
+        printer = self.printers.get(headers.get("X-Api-Key"))
+        if printer is None:
+            return 403, {"error": "Invalid API key"}
+        if printer["dead"]:
+            if self.deadDelay > 0:
+                time.sleep(self.deadDelay)
+            return None
+        now = time.time()
+        with self.lock:
+            if method == "GET" and path == "/api/job":
+                return 200, self._job(printer, now)
+            if method == "GET" and path == "/api/printerprofiles":
+                return 200, {"profiles": {"_default": {"name": printer["name"]}}}
+            if method == "GET" and path == "/api/files":
+                return 200, {"files": [{"name": name, "origin": "local"} for name in printer["files"]]}
+            if method == "POST" and path == "/api/files/local":
+                if printer["file"] is not None:
+                    return 409, {"error": "Printer is busy"}
+                name = self._uploadedName(headers, body)
+                printer["files"].append(name)
+                printer["file"] = name
+                printer["startedAt"] = now
+                printer["duration"] = self.printSeconds * self.random.uniform(0.5, 1.5)
+                self.dispatched[os.path.splitext(name)[0]] = now
+                return 201, {"done": True, "files": {"local": {"name": name, "origin": "local"}}}
+            if method == "POST" and path == "/api/connection":
+                command = json.loads(body or b"{}").get("command")
+                if command == "disconnect" and printer["file"] is not None:
+                    printer["busy"] += min(now - printer["startedAt"], printer["duration"])
+                    printer["file"] = None
+                    printer["startedAt"] = None
+                return 204, ""
+        return 404, {"error": "Not found"}
+
+    def _uploadedName(self, headers, body):
+        message = BytesParser(policy=policy.default).parsebytes(
+            b"Content-Type: " + headers.get("Content-Type", "").encode("latin-1") + b"\r\n\r\n" + body
+        )
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                return os.path.basename(part.get_filename() or "unknown.gcode")
+        return "unknown.gcode"
+
+    ### seconds each printer spent actually printing since the farm started ###
+    def busySeconds(self, now=None):
+        now = now or time.time()
+        total = 0.0
+        with self.lock:
+            for api in self.printers:
+                printer = self.printers[api]
+                total += printer["busy"]
+                if printer["file"] is not None:
+                    total += min(now - printer["startedAt"], printer["duration"])
+        return total
+
+### a throwaway working directory with config files pointing at the fakes, with jira and octoprint imported against it ###
+class Farm:
+    def __init__(self, printers=5, tickets=100, latency=0.0, failureRate=0.0, printSeconds=60.0,
+                 pageSize=50, badRate=0.0, dead=0, deadDelay=0.0, seed=0):
+        self.jiraServer = FakeJira(tickets=tickets, pageSize=pageSize, badRate=badRate,
+                                   latency=latency, failureRate=failureRate, seed=seed)
+        self.octoprintServer = FakeOctoPrint(printers=printers, printSeconds=printSeconds, dead=dead,
+                                             deadDelay=deadDelay, latency=latency, failureRate=failureRate, seed=seed + 1)
+        self.directory = None
+        self.previousDirectory = None
+        self.jira = None
+        self.octoprint = None
+
+    def config(self):
+        with open(os.path.join(ROOT, "config.yml"), "r") as yamlfile:
+            config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+        config.update({
+            "base_url": "http://" + self.jiraServer.address,
+            "search_url": "search?jql=status%20%3D%20Open",
+            "printing_url": "search?jql=status%20%3D%20%22In%20Progress%22",
+            "ticketStartString": TICKET_PREFIX,
+            "Make_files_anon": True,
+            "Save_printed_files": False,
+            "use_nice_list": False,
+            "use_naughty_list": True,
+            "resetConnectionDelay": 0,
+            "gcode_check_text": {"startGcode": "G28", "material": "M1", "notes_print_settings": "EHSL"},
+        })
+        config["reciept_printer"]["print_physical_reciept"] = False
+        return config
+
+    def __enter__(self):
+        self.jiraServer.start()
+        self.octoprintServer.start()
+        self.directory = tempfile.mkdtemp(prefix="farmsim-")
+        files = {
+            "config.yml": self.config(),
+            "printers.yml": self.octoprintServer.printerConfig(),
+            "lists.yml": {"NICE": [], "NAUGHTY": []},
+            "keys.yml": {"CLASSKEYS": {}},
+        }
+        for name in files:
+            with open(os.path.join(self.directory, name), "w") as f:
+                yaml.safe_dump(files[name], f, default_flow_style=False)
+        os.mkdir(os.path.join(self.directory, "jiradownloads"))
+        os.mkdir(os.path.join(self.directory, "archive_files"))
+        self.previousDirectory = os.getcwd()
+        os.chdir(self.directory)
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        # both modules read their yml files at import time so they are reloaded inside the new directory
+        for name in ("health", "farmstate", "jira", "octoprint"):
+            if name in sys.modules:
+                importlib.reload(sys.modules[name])
+            else:
+                importlib.import_module(name)
+        self.jira = sys.modules["jira"]
+        self.octoprint = sys.modules["octoprint"]
+        return self
+
+    def __exit__(self, *exc):
+        os.chdir(self.previousDirectory)
+        self.jiraServer.stop()
+        self.octoprintServer.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return False
+
+    ### the same jobs main.py schedules, in the same order ###
+    def jobs(self):
+        return [self.jira.getGcode, self.octoprint.eachNewFile, self.octoprint.PrintIsFinished, self.jira.askedForStatus]
+
+    ### run one control loop tick, a job that raises is counted instead of killing the run ###
+    def tick(self):
+        durations = {}
+        failures = []
+        for job in self.jobs():
+            start = time.perf_counter()
+            try:
+                job()
+            except Exception as e:
+                failures.append(job.__name__ + ": " + type(e).__name__)
+            durations[job.__name__] = time.perf_counter() - start
+        return durations, failures
+
+    def queueDepth(self):
+        return len([f for f in os.listdir("jiradownloads") if f.endswith(".gcode")])